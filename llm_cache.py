@@ -0,0 +1,64 @@
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence
+
+import diskcache
+import numpy as np
+import orjson
+
+
+class LLMCache:
+    """Two-tier LLM response cache persisted on disk.
+
+    The exact tier is keyed on a SHA-256 of the request (model, messages, sampling
+    parameters). The semantic tier stores embeddings of earlier user requests per
+    scope and returns a stored response when a new request is similar enough.
+
+    Entries expire after ``ttl`` seconds (never if None), and the least recently
+    stored ones are evicted once the cache grows past ``size_limit`` bytes.
+    """
+
+    def __init__(self, directory: str = ".llm_cache", similarity_threshold: float = 0.92,
+                 max_semantic_entries: int = 200, cache_sampled: bool = False,
+                 ttl: Optional[float] = None, size_limit: int = 2 ** 30):
+        self._cache = diskcache.Cache(directory, size_limit=size_limit)
+        self.similarity_threshold = similarity_threshold
+        self.max_semantic_entries = max_semantic_entries
+        self.cache_sampled = cache_sampled
+        self.ttl = ttl
+
+    @staticmethod
+    def cache_key(model: str, messages: List[Dict[str, str]], **params) -> str:
+        """Return a stable SHA-256 key for a chat completion request."""
+        payload = orjson.dumps({"model": model, "messages": messages, "params": params}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+
+    def should_cache(self, **params) -> bool:
+        """Only deterministic requests are cached unless sampled responses were opted in."""
+        return self.cache_sampled or params.get("temperature") == 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the response stored under an exact key, if any."""
+        return self._cache.get(("exact", key))
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a response under an exact key."""
+        self._cache.set(("exact", key), value, expire=self.ttl)
+
+    def get_similar(self, scope: str, embedding: Sequence[float]) -> Optional[Any]:
+        """Return the stored response whose request embedding is most similar, above the threshold."""
+        entries = self._cache.get(("semantic", scope), [])
+        if not entries:
+            return None
+        matrix = np.array([stored for stored, _ in entries], dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return entries[best][1]
+
+    def add_similar(self, scope: str, embedding: Sequence[float], value: Any) -> None:
+        """Record a response for semantic lookup, keeping only the most recent entries per scope."""
+        entries = self._cache.get(("semantic", scope), [])
+        entries.append((list(embedding), value))
+        self._cache.set(("semantic", scope), entries[-self.max_semantic_entries:], expire=self.ttl)
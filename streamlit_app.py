@@ -1,27 +1,398 @@
 import streamlit as st
 import pandas as pd
-from openai import OpenAI
+import pyarrow as pa
+from pyarrow import compute as pc
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
 import os
-import json
+import base64
+import gzip
+import orjson
+import hashlib
+import zlib
 import logging
 import traceback
-from typing import Optional, Dict, List
+import asyncio
+import threading
+import queue
+import time
+import random
+import concurrent.futures
+from typing import TYPE_CHECKING, Callable, Optional, Dict, List, Tuple
 import re
+import collections
+from string import Template
+
+from llm_cache import LLMCache
+
+# openai (httpx, anyio, pydantic) is only imported once an API call is needed,
+# which keeps it off the app's cold-start path
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Define MAX_WORKFLOW_HISTORY constant
-MAX_WORKFLOW_HISTORY = 10
+# Define MAX_WORKFLOW_HISTORY constant; older steps are evicted and their code released
+MAX_WORKFLOW_HISTORY = 50
+
+# LLM request settings
+LLM_MODEL = "gpt-4o-mini"
+# Single completions are requested deterministically so repeated prompts hit the caches
+LLM_SEED = 42
+EMBEDDING_MODEL = "text-embedding-3-small"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+LLM_CACHE_TTL = 24 * 3600
+LLM_CACHE_SIZE_LIMIT = 256 * 2 ** 20
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENCY", "5"))  # per client
+MAX_LLM_RETRIES = 3
+# Upper bound on a single wait between retries, whatever the server's retry-after says
+MAX_RETRY_DELAY = 60
+MAX_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM", "500"))
+MAX_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM", "200000"))
+# The SDK drops idle connections after 5 seconds, so nearly every user interaction
+# would pay a fresh TLS handshake; keep a small pool alive between interactions instead
+HTTP_KEEPALIVE_CONNECTIONS = 8
+HTTP_KEEPALIVE_EXPIRY = 120.0
+# Keys typed into the sidebar each get their own pooled clients, request semaphore and rate
+# limiter; keep the most recent ones
+MAX_CACHED_CLIENTS = 16
+
+# Prompt data summary: rows shown verbatim and example values listed per non-numeric column
+PROMPT_SAMPLE_ROWS = 3
+PROMPT_EXAMPLE_VALUES = 3
+
+# Seconds between background status checks of a submitted batch
+BATCH_POLL_INTERVAL = 30
+
+# Minimum seconds between UI refreshes while a completion streams in
+STREAM_RENDER_INTERVAL = 0.1
+
+# Completion budget: the ceiling covers a full chart; edits of existing code get about
+# its length (~3 characters per token) plus 20% headroom, so short edits reserve less
+MAX_OUTPUT_TOKENS = 2500
+MIN_OUTPUT_TOKENS = 512
+
+# Modification requests ask for several alternatives in one call (input tokens are billed once)
+MODIFICATION_VARIANTS = 3
+VARIANT_TEMPERATURE = 0.9
+# Each repair round asks for this many candidates at once and keeps the first that
+# validates, so a single bad candidate does not cost a whole extra round trip
+REFINEMENT_CANDIDATES = 2
+
+# Markdown code fences the LLM sometimes wraps its answer in
+_CODE_FENCE_RE = re.compile(r"```(?:javascript)?")
+# Blank lines and "#" lines (stray markdown headings) dropped from a response in one pass
+_NON_CODE_LINE_RE = re.compile(r'^[^\S\n]*(?:#[^\n]*)?(?:\n|\Z)', re.MULTILINE)
+# A line that opens the entry point, which the cleaned response must define
+_ENTRY_POINT_RE = re.compile(r'^[^\S\n]*function createVisualization', re.MULTILINE)
+# Signature every generated visualization must define
+_CREATE_VIZ_RE = re.compile(r'function\s+createVisualization\s*\(data,\s*svgElement\)\s*{')
+# Braces and the basic D3 v7 calls validation looks for, matched in one scan of the code
+_VALIDATION_TOKEN_RE = re.compile(r'[{}]|d3\.(?:select|scaleLinear|axisBottom|axisLeft)')
+# Comment lines such as "// Add X axis" that open a named section of generated code
+_SECTION_MARKER_RE = re.compile(r'^[ \t]*//[ \t]*(.+?)[ \t]*$', re.MULTILINE)
+_WORD_RE = re.compile(r'[a-z]+')
+# Words too common in requests and section names to say which section a request is about
+_SECTION_STOPWORDS = {"add", "and", "the", "for", "with", "make", "create", "set", "use", "from", "into", "data"}
+
+# Column lists and value ranges are computed in pandas over the full dataset and handed
+# to the page, so generated code does not have to scan every row to size its scales
+VIZ_META_REQUIREMENT = ("A global vizMeta object is available with columns (all column names except source), "
+                        "numericColumns and extents (per-column [min, max] over the full dataset); use it for "
+                        "column lists and scale domains instead of iterating over data")
+
+# Prompt and page templates are parsed once at import; string.Template's $-placeholders
+# also leave the braces of the surrounding JavaScript unescaped
+# The dataset's schema and sample go in the system message, ahead of anything specific to
+# one request, so every request on the same data shares a prefix OpenAI can cache
+D3_SYSTEM_PROMPT = Template("""You are a D3.js expert. Generate D3.js code for comparative visualization based on the given requirements.
+
+Data Schema:
+$schema_str
+
+Sample Data (CSV):
+$sample_csv""")
+
+GENERATION_PROMPT = Template("""
+    # D3.js Code Generation Task
+
+    Your task is to generate ONLY D3.js code version 7. Do not include any explanations, comments, or markdown formatting.
+
+    Requirements:
+    1. Create a function named createVisualization(data, svgElement)
+    2. Implement a visualization that compares data from two CSV files
+    3. Use D3.js version 7 syntax
+    4. $viz_meta_requirement
+
+    IMPORTANT: Your entire response must be valid D3.js code that can be executed directly. Do not include any text before or after the code.
+    """)
+
+MODIFICATION_PROMPT = Template("""
+        # D3.js Code Generation Task
+
+        Your task is to generate ONLY D3.js code version 7. Do not include any explanations, comments, or markdown formatting.
+
+        Requirements:
+        1. Create a function named createVisualization(data, svgElement)
+        2. Implement a visualization that satisfies this user prompt:
+        ---
+        $user_input
+        ---
+        3. Use D3.js version 7 syntax
+        4. $viz_meta_requirement
+
+        Current Code:
+        ```javascript
+        $current_code
+        ```
+
+        IMPORTANT: Your entire response must be valid D3.js code that can be executed directly. Do not include any text before or after the code.
+        """)
+
+REFINEMENT_PROMPT = Template("""
+    The following D3 code needs refinement to be valid:
+    
+    $code
+    
+    Please provide a corrected version that:
+    1. Defines a createVisualization(data, svgElement) function
+    2. Uses only D3.js version 7 syntax
+    3. Creates a valid visualization
+    
+    Return ONLY the corrected D3 code without any explanations or comments.
+    """)
+
+VISUALIZATION_PAGE = Template("""
+    <div id="visualization"></div>
+    <script src="https://d3js.org/d3.v7.min.js"></script>
+    <script src="https://cdn.jsdelivr.net/npm/apache-arrow@15/Arrow.es2015.min.js"></script>
+    <script>
+        const vizMeta = $viz_meta;
+    </script>
+    <script>
+        $d3_code
+    </script>
+    <script>
+        // The generated code runs in its own script tag so that even a syntax error in
+        // it surfaces here, in the single error handler, instead of as a blank frame
+        (async function() {
+            try {
+                // Create the SVG element
+                const svgElement = d3.select("#visualization")
+                    .append("svg")
+                    .attr("width", 800)
+                    .attr("height", 500)
+                    .node();
+                
+                // Inflate the gzipped Arrow IPC payload and decode it back into plain row objects
+                const raw = Uint8Array.from(atob("$data_ipc"), c => c.charCodeAt(0));
+                const inflated = new Blob([raw]).stream().pipeThrough(new DecompressionStream("gzip"));
+                const ipc = new Uint8Array(await new Response(inflated).arrayBuffer());
+                const vizData = Arrow.tableFromIPC(ipc).toArray().map(row => row.toJSON());
+                
+                // Call the createVisualization function
+                createVisualization(vizData, svgElement);
+            } catch (e) {
+                d3.select("#visualization").html("")
+                    .append("pre")
+                    .style("color", "#b00020")
+                    .text("Error rendering visualization: " + e.message);
+            }
+        })();
+    </script>
+    """)
+
+# Modifications that only touch some sections of the current code send just those
+# sections; the fixed instructions sit in the system message so the prefix is reusable
+SECTION_PATCH_SYSTEM_PROMPT = Template("""You are a D3.js expert editing one part of an existing D3.js version 7 visualization.
+You are given a modification request and the sections of the current code it concerns; the data schema and sample data follow these instructions.
+Rewrite only those sections. Keep each section's leading comment line and do not rename functions or variables used elsewhere.
+$viz_meta_requirement.
+Respond with a JSON object of the form {"sections": {"<section name>": "<complete new code for that section>"}}.
+
+Data Schema:
+$schema_str
+
+Sample Data (CSV):
+$sample_csv""")
+
+SECTION_PATCH_PROMPT = Template("""Modification request:
+$user_input
+
+Sections to rewrite:
+$target_code""")
+
+# Maximum number of rows serialized into the visualization page
+MAX_VIZ_ROWS = 2000
+# Rows each source keeps in that sample however lopsided the two files are
+MIN_VIZ_ROWS_PER_SOURCE = 200
+# Integer types, narrowest first, that Arrow JS reads as plain numbers
+_WIRE_INT_TYPES = (pa.int8(), pa.int16(), pa.int32())
+# Values of the Source column tagging each row with the upload it came from
+SOURCE_LABELS = pa.array(["CSV file 1", "CSV file 2"])
+# String columns whose non-empty values parse as numbers at least this often become numeric
+NUMERIC_COERCION_THRESHOLD = 0.95
+# Placeholders read as missing while parsing, on top of Arrow's defaults ("", "NA", "n/a", ...),
+# so numeric columns using them are typed by the parser itself. String columns keep them as text.
+CSV_NULL_VALUES = pacsv.ConvertOptions().null_values + ["-", "--", "?", "None", "none"]
+# Decimal and integer literals (after trimming whitespace) for that coercion
+_NUMBER_PATTERN = r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$'
+_INTEGER_PATTERN = r'^[-+]?\d+$'
+# Column names are lowercased and have spaces replaced with this table
+_COLUMN_NAME_TABLE = str.maketrans(' ', '_')
+# Parsed uploads are shared by all sessions and never expire on their own, so keep
+# only the most recent ones
+MAX_CACHED_UPLOADS = 8
+# Parsed uploads are also saved as Parquet, keyed on the file's hash, so a restarted
+# process reloads them instead of parsing the CSV again; only the newest files are kept
+PARSED_CSV_CACHE_DIR = os.getenv("PARSED_CSV_CACHE_DIR", ".parsed_csv_cache")
+MAX_PARSED_CSV_FILES = 32
+# Parquet metadata key holding the schema the CSV parse produced
+PARSED_SCHEMA_KEY = b"chartchat.parsed_schema"
+PARSED_CSV_WRITER_THREAD = "parsed-csv-writer"
+
+AGGREGATE_FALLBACK_CODE = """
+function createVisualization(data, svgElement) {
+    // Per-source totals are computed server-side; the raw rows are not needed here
+    const summary = __SUMMARY__;
+    const valueLabel = __VALUE_LABEL__;
+
+    const margin = { top: 20, right: 20, bottom: 50, left: 70 };
+    const width = 800 - margin.left - margin.right;
+    const height = 500 - margin.top - margin.bottom;
+
+    const svg = d3.select(svgElement)
+        .attr("width", width + margin.left + margin.right)
+        .attr("height", height + margin.top + margin.bottom)
+        .append("g")
+        .attr("transform", `translate(${margin.left},${margin.top})`);
+
+    const xScale = d3.scaleBand()
+        .domain(summary.map(d => d.source))
+        .range([0, width])
+        .padding(0.3);
+
+    const yScale = d3.scaleLinear()
+        .domain([0, d3.max(summary, d => +d.value)])
+        .nice()
+        .range([height, 0]);
+
+    svg.selectAll("rect")
+        .data(summary)
+        .join("rect")
+        .attr("x", d => xScale(d.source))
+        .attr("y", d => yScale(+d.value))
+        .attr("width", xScale.bandwidth())
+        .attr("height", d => height - yScale(+d.value))
+        .attr("fill", d => d.source === "CSV file 1" ? "#69b3a2" : "#404080");
+
+    svg.append("g")
+        .attr("transform", `translate(0, ${height})`)
+        .call(d3.axisBottom(xScale));
+
+    svg.append("g")
+        .call(d3.axisLeft(yScale));
+
+    svg.append("text")
+        .attr("transform", "rotate(-90)")
+        .attr("x", -height / 2)
+        .attr("y", -margin.left + 20)
+        .attr("text-anchor", "middle")
+        .text(valueLabel);
+}
+"""
+
+# Above this many rows the fallback chart draws to a canvas instead of one SVG node per row
+CANVAS_ROW_THRESHOLD = 1000
+
+CANVAS_FALLBACK_CODE = """
+function createVisualization(data, svgElement) {
+    const margin = { top: 20, right: 20, bottom: 50, left: 50 };
+    const width = 800 - margin.left - margin.right;
+    const height = 500 - margin.top - margin.bottom;
+
+    // Swap the provided SVG for a canvas so bars are pixels rather than DOM nodes
+    const container = d3.select(svgElement.parentNode);
+    d3.select(svgElement).remove();
+    const canvas = container.append("canvas")
+        .attr("width", width + margin.left + margin.right)
+        .attr("height", height + margin.top + margin.bottom)
+        .node();
+    const ctx = canvas.getContext("2d");
+    ctx.translate(margin.left, margin.top);
+
+    // Assuming the first column is for x-axis and second for y-axis
+    const xKey = Object.keys(data[0])[0];
+    const yKey = Object.keys(data[0])[1];
+
+    const xScale = d3.scaleBand()
+        .domain(data.map(d => d[xKey]))
+        .range([0, width])
+        .padding(0.1);
+
+    const yScale = d3.scaleLinear()
+        .domain([0, d3.max(data, d => +d[yKey])])
+        .range([height, 0]);
+
+    data.forEach(d => {
+        ctx.fillStyle = d.source === "CSV file 1" ? "#69b3a2" : "#404080";
+        ctx.fillRect(xScale(d[xKey]), yScale(+d[yKey]), xScale.bandwidth(), height - yScale(+d[yKey]));
+    });
+
+    // Reuse a d3 shape generator against the canvas context for the axis lines
+    const line = d3.line().context(ctx);
+    ctx.beginPath();
+    line([[0, 0], [0, height], [width, height]]);
+    ctx.strokeStyle = "#000";
+    ctx.stroke();
+
+    ctx.fillStyle = "#000";
+    ctx.textAlign = "right";
+    ctx.textBaseline = "middle";
+    yScale.ticks(10).forEach(t => ctx.fillText(t, -6, yScale(t)));
+
+    ctx.textAlign = "center";
+    ctx.textBaseline = "alphabetic";
+    ctx.fillText(xKey, width / 2, height + margin.top + 20);
+    ctx.save();
+    ctx.translate(-margin.left + 20, height / 2);
+    ctx.rotate(-Math.PI / 2);
+    ctx.fillText(yKey, 0, 0);
+    ctx.restore();
+}
+"""
 
 # Initialize session state
 if 'workflow_history' not in st.session_state:
-    st.session_state.workflow_history = []
+    st.session_state.workflow_history = collections.deque(maxlen=MAX_WORKFLOW_HISTORY)
+if 'code_store' not in st.session_state:
+    # Content-addressed, zlib-compressed code shared by history steps, with per-hash reference counts
+    st.session_state.code_store = {}
+    st.session_state.code_refs = {}
+if 'history_version' not in st.session_state:
+    st.session_state.history_version = 0
 if 'current_viz' not in st.session_state:
     st.session_state.current_viz = None
 if 'preprocessed_df' not in st.session_state:
     st.session_state.preprocessed_df = None
+if 'variants' not in st.session_state:
+    st.session_state.variants = []
+if 'batch_job' not in st.session_state:
+    st.session_state.batch_job = None
+if 'pending_batch' not in st.session_state:
+    st.session_state.pending_batch = []
+if 'prompt_ctx' not in st.session_state:
+    st.session_state.prompt_ctx = None
+if 'upload_key' not in st.session_state:
+    st.session_state.upload_key = None
+if 'data_fingerprint' not in st.session_state:
+    st.session_state.data_fingerprint = None
+if 'last_modification' not in st.session_state:
+    # (request, hash of the code it produced) for the latest applied modification
+    st.session_state.last_modification = None
 
 def get_api_key() -> Optional[str]:
     """Securely retrieve the API key."""
@@ -32,51 +403,449 @@ def get_api_key() -> Optional[str]:
             st.sidebar.warning("It's recommended to use environment variables or Streamlit secrets for API keys.")
     return api_key
 
+def _connection_limits(max_keepalive_connections: int):
+    """Return the SDK's default connection limits with a longer-lived keep-alive pool.
+
+    The limits type comes from the SDK so it matches the HTTP client it was built against.
+    """
+    from openai import DEFAULT_CONNECTION_LIMITS
+    return type(DEFAULT_CONNECTION_LIMITS)(max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                                           max_keepalive_connections=max_keepalive_connections,
+                                           keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+@st.cache_resource(max_entries=MAX_CACHED_CLIENTS)
+def _get_client(api_key: str) -> "OpenAI":
+    """Return the OpenAI client for this key, reused across reruns to keep connections alive."""
+    from openai import OpenAI, DefaultHttpxClient
+    limits = _connection_limits(HTTP_KEEPALIVE_CONNECTIONS)
+    return OpenAI(api_key=api_key, max_retries=3, timeout=60, http_client=DefaultHttpxClient(limits=limits, timeout=60))
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def test_api_key(api_key: str) -> bool:
-    """Test if the provided API key is valid."""
-    client = OpenAI(api_key=api_key)
+    """Test if the provided API key is valid (cached for an hour per key)."""
+    client = _get_client(api_key)
     try:
-        client.models.list()
+        # Fetching the one model the app uses is a smaller probe than listing every model
+        client.models.retrieve(LLM_MODEL)
         return True
     except Exception as e:
         logger.error(f"API key validation failed: {str(e)}")
         return False
 
-def preprocess_data(file1, file2) -> pd.DataFrame:
-    """Preprocess and merge the two dataframes for comparison."""
+@st.cache_resource
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Start the background event loop shared by all async OpenAI calls."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource(max_entries=MAX_CACHED_CLIENTS)
+def _get_async_client(api_key: str) -> "AsyncOpenAI":
+    """Return the AsyncOpenAI client for this key, reused across reruns."""
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    limits = _connection_limits(max(HTTP_KEEPALIVE_CONNECTIONS, MAX_CONCURRENT_REQUESTS))
+    # _agenerate/_astream own retries (honoring retry-after); SDK retries on top would multiply attempts
+    return AsyncOpenAI(api_key=api_key, max_retries=0, timeout=60, http_client=DefaultAsyncHttpxClient(limits=limits, timeout=60))
+
+@st.cache_resource(max_entries=MAX_CACHED_CLIENTS)
+def _get_request_semaphore(api_key: str) -> asyncio.Semaphore:
+    """Return the semaphore bounding in-flight requests for this key."""
+    return asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+class _TokenBucket:
+    """Request and token capacity that requests wait on before they are sent.
+
+    Pacing submissions up front keeps throughput near the account limits instead of
+    oscillating between bursts of 429s and backoff. Capacity refills continuously at
+    the per-minute limits, as OpenAI's own limiter does, rather than all at once when
+    a fixed one-minute window ends.
+    """
+
+    def __init__(self, max_requests: int, max_tokens: int):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.available_requests = float(max_requests)
+        self.available_tokens = float(max_tokens)
+        self._last_refill = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._last_refill = now - self._last_refill, now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        # A request larger than the whole bucket waits for a full one, so it cannot stall forever
+        tokens = min(tokens, self.max_tokens)
+        while True:
+            self._refill()
+            if self.available_requests >= 1 and self.available_tokens >= tokens:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return
+            # Sleep until enough of both capacities should have come back
+            await asyncio.sleep(max((1 - self.available_requests) * 60 / self.max_requests,
+                                    (tokens - self.available_tokens) * 60 / self.max_tokens, 0.01))
+
+@st.cache_resource(max_entries=MAX_CACHED_CLIENTS)
+def _get_rate_limiter(api_key: str) -> _TokenBucket:
+    """Return the request/token budget shared by all calls made with this key."""
+    return _TokenBucket(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+def _estimate_tokens(messages: List[Dict[str, str]], **params) -> int:
+    """Roughly estimate the tokens a request will consume (about 4 characters per token)."""
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    return prompt_tokens + params.get("max_tokens", 0) * params.get("n", 1)
+
+def _transient_openai_errors() -> tuple:
+    """Return the OpenAI exception types that are worth retrying."""
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+    return (APIConnectionError, APITimeoutError, RateLimitError)
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Return how long to wait before retrying: the server's retry-after hint if sent, else jittered backoff."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                return min(float(response.headers[header]) * scale, MAX_RETRY_DELAY)
+            except (KeyError, ValueError):
+                continue
+    # Jitter keeps concurrent requests that failed together from retrying in lockstep
+    return min(2 ** attempt + random.uniform(0, 1), MAX_RETRY_DELAY)
+
+async def _agenerate(client: "AsyncOpenAI", semaphore: asyncio.Semaphore, limiter: _TokenBucket, messages: List[Dict[str, str]], **params) -> List[str]:
+    """Request a chat completion, retrying transient failures with exponential backoff.
+
+    Returns the content of every choice, so callers passing ``n`` get all variants.
+    """
+    for attempt in range(MAX_LLM_RETRIES):
+        try:
+            await limiter.acquire(_estimate_tokens(messages, **params))
+            async with semaphore:
+                response = await client.chat.completions.create(model=LLM_MODEL, messages=messages, **params)
+            return [choice.message.content for choice in response.choices]
+        except _transient_openai_errors() as e:
+            if attempt == MAX_LLM_RETRIES - 1:
+                raise
+            logger.warning(f"OpenAI request failed (attempt {attempt + 1}/{MAX_LLM_RETRIES}): {str(e)}")
+            await asyncio.sleep(_retry_delay(e, attempt))
+
+async def _astream(client: "AsyncOpenAI", semaphore: asyncio.Semaphore, limiter: _TokenBucket, messages: List[Dict[str, str]], deltas: "queue.Queue", **params) -> List[str]:
+    """Stream a chat completion, pushing (choice index, text) deltas onto a queue as they arrive.
+
+    A None item tells the consumer that a retry started and partial output should be discarded.
+    """
+    for attempt in range(MAX_LLM_RETRIES):
+        try:
+            await limiter.acquire(_estimate_tokens(messages, **params))
+            async with semaphore:
+                stream = await client.chat.completions.create(model=LLM_MODEL, messages=messages, stream=True, **params)
+                try:
+                    buffers: Dict[int, List[str]] = {}
+                    async for chunk in stream:
+                        for choice in chunk.choices:
+                            delta = choice.delta.content or ""
+                            buffers.setdefault(choice.index, []).append(delta)
+                            deltas.put((choice.index, delta))
+                finally:
+                    await stream.close()
+            return ["".join(buffers[index]) for index in sorted(buffers)]
+        except _transient_openai_errors() as e:
+            if attempt == MAX_LLM_RETRIES - 1:
+                raise
+            logger.warning(f"OpenAI stream failed (attempt {attempt + 1}/{MAX_LLM_RETRIES}): {str(e)}")
+            deltas.put(None)
+            await asyncio.sleep(_retry_delay(e, attempt))
+
+def _run_async(coro):
+    """Run a coroutine on the shared event loop and block until it completes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+def chat_completion_stream(api_key: str, messages: List[Dict[str, str]], on_text: Callable[[str], None],
+                           stop_when: Optional[Callable[[], bool]] = None, **params) -> Optional[List[str]]:
+    """Stream completions for one prompt, calling on_text with the first choice's text so far.
+
+    Runs on the script thread so on_text may update Streamlit elements; the request is
+    cancelled (closing the HTTP stream) if the script run is interrupted, or abandoned
+    with a None result as soon as stop_when returns True.
+    """
+    client = _get_async_client(api_key)
+    semaphore = _get_request_semaphore(api_key)
+    limiter = _get_rate_limiter(api_key)
+    deltas = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(_astream(client, semaphore, limiter, messages, deltas, **params), _get_event_loop())
+    buf: List[str] = []
+    last_render = 0.0
+    pending = False
+    try:
+        while not (future.done() and deltas.empty()):
+            if stop_when is not None and stop_when():
+                return None
+            try:
+                items = [deltas.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # Drain whatever else arrived so the UI is updated once per batch of deltas
+            while not deltas.empty():
+                items.append(deltas.get_nowait())
+            for item in items:
+                if item is None:
+                    buf.clear()
+                elif item[0] == 0:
+                    buf.append(item[1])
+            # Each update resends the whole text to the browser, so cap the refresh rate
+            pending = True
+            if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                on_text("".join(buf))
+                last_render = time.monotonic()
+                pending = False
+        if pending:
+            on_text("".join(buf))
+        return future.result()
+    finally:
+        future.cancel()
+
+async def _aembed(client: "AsyncOpenAI", semaphore: asyncio.Semaphore, text: str) -> List[float]:
+    """Return the embedding vector for a piece of text."""
+    async with semaphore:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+def submit_embedding(api_key: str, text: str) -> concurrent.futures.Future:
+    """Start embedding text on the shared event loop and return a future for the vector."""
+    return asyncio.run_coroutine_threadsafe(_aembed(_get_async_client(api_key), _get_request_semaphore(api_key), text), _get_event_loop())
+
+@st.cache_resource
+def _get_llm_cache() -> LLMCache:
+    """Return the on-disk LLM response cache shared by all sessions."""
+    # Variants are sampled, but identical prompts are already treated as interchangeable
+    # by the in-memory cache, so sampled responses are cached too
+    return LLMCache(LLM_CACHE_DIR, similarity_threshold=SEMANTIC_CACHE_THRESHOLD, cache_sampled=True,
+                    ttl=LLM_CACHE_TTL, size_limit=LLM_CACHE_SIZE_LIMIT)
+
+def submit_batch(api_key: str, requests: List[Dict]) -> str:
+    """Submit chat requests through the OpenAI Batch API and return the batch id.
+
+    Each request is a chat completion body without the model (messages plus sampling
+    parameters). Batch requests cost half as much and draw on a separate rate-limit
+    pool, but complete within a 24h window, so they are only used for non-interactive work.
+    """
+    lines = [
+        orjson.dumps({
+            "custom_id": f"request-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": LLM_MODEL, **request}
+        })
+        for i, request in enumerate(requests)
+    ]
+    client = _get_client(api_key)
+    batch_file = client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    logger.info(f"Submitted batch {batch.id} with {len(lines)} requests")
+    return batch.id
+
+def retrieve_batch(api_key: str, batch_id: str) -> Optional[List[List[str]]]:
+    """Return the completions of each request of a finished batch in submission order, or None while it is still running.
+
+    Requests that failed inside the batch get an empty list.
+    """
+    client = _get_client(api_key)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("failed", "expired", "cancelled"):
+        raise ValueError(f"Batch {batch_id} {batch.status}")
+    if batch.status != "completed":
+        return None
+    
+    results = [[] for _ in range(batch.request_counts.total)] if batch.request_counts else []
+    if batch.output_file_id is None:
+        return results
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        if record.get("error") or not record.get("response"):
+            logger.warning(f"Batch request {record.get('custom_id')} failed: {record.get('error')}")
+            continue
+        index = int(record["custom_id"].rsplit("-", 1)[1])
+        results.extend([] for _ in range(index + 1 - len(results)))
+        results[index] = [choice["message"]["content"] for choice in record["response"]["body"]["choices"]]
+    return results
+
+def _save_parsed_csv(table: pa.Table, path: str):
+    """Write a parsed upload to the Parquet cache, then drop the oldest files beyond the limit."""
+    try:
+        os.makedirs(PARSED_CSV_CACHE_DIR, exist_ok=True)
+        # Parquet has no second-resolution timestamps, so the parsed schema is stored with
+        # the file and the loaded table is cast back to it
+        table = table.replace_schema_metadata({PARSED_SCHEMA_KEY: table.schema.serialize().to_pybytes()})
+        # Written under a temporary name so a concurrent reader never sees a partial file
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        cached = sorted((entry for entry in os.scandir(PARSED_CSV_CACHE_DIR) if entry.name.endswith(".parquet")),
+                        key=lambda entry: entry.stat().st_mtime)
+        for entry in cached[:-MAX_PARSED_CSV_FILES]:
+            os.remove(entry.path)
+    except OSError as e:
+        logger.warning(f"Could not cache parsed upload: {str(e)}")
+
+def _read_csv_table(data: bytes) -> pa.Table:
+    """Parse CSV bytes with Arrow, reusing the Parquet copy saved by an earlier run if there is one."""
+    # The parse options are part of the key, so changing them does not reuse stale tables
+    digest = hashlib.sha1(data)
+    digest.update(repr(CSV_NULL_VALUES).encode())
+    path = os.path.join(PARSED_CSV_CACHE_DIR, digest.hexdigest() + ".parquet")
+    if os.path.exists(path):
+        try:
+            table = pq.read_table(path)
+            return table.cast(pa.ipc.read_schema(pa.py_buffer(table.schema.metadata[PARSED_SCHEMA_KEY])))
+        except (OSError, pa.ArrowInvalid, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable parsed upload {path}: {str(e)}")
+    # Arrow's reader tokenizes in parallel straight from the upload's buffer and hands its
+    # buffers to pandas without copying
+    table = pacsv.read_csv(pa.BufferReader(data), read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 20),
+                           convert_options=pacsv.ConvertOptions(null_values=CSV_NULL_VALUES))
+    # Saving is off the request path; the table is immutable, so sharing it with the writer is safe
+    threading.Thread(target=_save_parsed_csv, args=(table, path), name=PARSED_CSV_WRITER_THREAD, daemon=True).start()
+    return table
+
+# Arrow tables are immutable, so the parsed table is shared as-is; st.cache_data would
+# keep a pickled copy per entry and unpickle another full copy on every hit
+@st.cache_resource(show_spinner=False, max_entries=2 * MAX_CACHED_UPLOADS)
+def _parse_csv(data: bytes, source: int) -> pa.Table:
+    """Parse uploaded CSV bytes tagged with their Source (an index into SOURCE_LABELS), memoized so reruns skip parsing."""
+    # isspace() checks in place; strip() would copy the whole upload first
+    if not data or data.isspace():
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    table = _read_csv_table(data)
+    # Source is one int8 index per row into a dictionary shared by both files, so the
+    # concatenated column needs no dictionary unification and behaves like a categorical
+    indices = pa.repeat(pa.scalar(source, pa.int8()), table.num_rows)
+    labels = pa.DictionaryArray.from_arrays(indices, SOURCE_LABELS)
+    # An upload's own Source column is overwritten, as assigning df['Source'] would
+    if 'Source' in table.column_names:
+        return table.set_column(table.column_names.index('Source'), 'Source', labels)
+    return table.append_column('Source', labels)
+
+def _coerce_numeric_strings(table: pa.Table) -> pa.Table:
+    """Convert string columns whose values are nearly all numeric, turning the stragglers into nulls.
+
+    Arrow infers a column as string as soon as one cell (e.g. "n/a" or "-") fails to
+    parse, so such columns are matched against a number pattern and cast in Arrow,
+    without a round trip through Python objects.
+    """
+    for i, field in enumerate(table.schema):
+        if not (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+            continue
+        values = pc.utf8_trim_whitespace(table.column(i))
+        present = pc.sum(pc.not_equal(values, "")).as_py() or 0
+        if not present:
+            continue
+        numeric = pc.match_substring_regex(values, _NUMBER_PATTERN)
+        parsed = pc.sum(numeric).as_py() or 0
+        if parsed < NUMERIC_COERCION_THRESHOLD * present:
+            continue
+        numbers = pc.if_else(numeric, values, None)
+        target = pa.float64()
+        if pc.sum(pc.match_substring_regex(values, _INTEGER_PATTERN)).as_py() == parsed:
+            target = pa.int64()
+        try:
+            converted = pc.cast(numbers, target)
+        except pa.ArrowInvalid:
+            # Integers too large for int64
+            converted = pc.cast(numbers, pa.float64())
+        table = table.set_column(i, field.with_type(converted.type), converted)
+    return table
+
+def _fill_missing(table: pa.Table) -> pa.Table:
+    """Fill nulls with 0 in numeric columns and "" in string columns.
+
+    Done per column in Arrow so columns without nulls are passed through untouched
+    rather than copied, and each column keeps its type.
+    """
+    for i, field in enumerate(table.schema):
+        column = table.column(i)
+        if column.null_count == 0:
+            continue
+        if pa.types.is_integer(field.type) or pa.types.is_floating(field.type) or pa.types.is_decimal(field.type):
+            fill = pa.scalar(0, field.type)
+        elif pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            fill = pa.scalar("", field.type)
+        else:
+            continue
+        table = table.set_column(i, field, pc.fill_null(column, fill))
+    return table
+
+def _normalize_column_names(names: List[str]) -> List[str]:
+    """Lower-case and tidy column names, suffixing any that would then collide.
+
+    Headers such as "Sales" and "sales" from the two files normalize to the same name;
+    the later one becomes "sales_2". The Source tag always keeps "source".
+    """
+    normalized = []
+    taken = {"source"}
+    for name in names:
+        base = name.lower().translate(_COLUMN_NAME_TABLE)
+        if name == 'Source':
+            normalized.append(base)
+            continue
+        candidate, suffix = base, 1
+        while candidate in taken:
+            suffix += 1
+            candidate = f"{base}_{suffix}"
+        taken.add(candidate)
+        normalized.append(candidate)
+    return normalized
+
+def merge_sources(data1: bytes, data2: bytes) -> pd.DataFrame:
+    """Parse both uploads, tag each row with its Source, concatenate and clean them."""
+    # Concatenating at the Arrow level only stitches chunks together; differing column
+    # sets are null-filled and compatible types (e.g. int64 and double) are unified
+    tables = [_parse_csv(data1, 0), _parse_csv(data2, 1)]
+    try:
+        merged = pa.concat_tables(tables, promote_options="permissive")
+    except pa.ArrowTypeError:
+        # Types that cannot be unified (e.g. int64 vs string) fall back to strings
+        schema1, schema2 = tables[0].schema, tables[1].schema
+        conflicting = {field.name for field in schema1 if field.name in schema2.names and schema2.field(field.name).type != field.type}
+        tables = [table.cast(pa.schema([field.with_type(pa.string()) if field.name in conflicting else field for field in table.schema]))
+                  for table in tables]
+        merged = pa.concat_tables(tables, promote_options="permissive")
+    # Standardize column names on the Arrow table, where renaming only touches the schema
+    merged = merged.rename_columns(_normalize_column_names(merged.column_names))
+    return _fill_missing(_coerce_numeric_strings(merged)).to_pandas(types_mapper=pd.ArrowDtype, self_destruct=True)
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_CACHED_UPLOADS)
+def prepare_data(data1: bytes, data2: bytes) -> Tuple[pd.DataFrame, str, Tuple[str, str]]:
+    """Merge both uploads and derive the fingerprint and prompt context, memoized on the bytes.
+
+    Re-uploading identical files, in this or any other session, skips all of this work.
+    The result is shared rather than pickled per hit, so callers take a shallow copy.
+    """
+    merged_df = merge_sources(data1, data2)
+    fingerprint = dataframe_fingerprint(merged_df)
+    return merged_df, fingerprint, build_prompt_context(merged_df)
+
+def preprocess_data(file1, file2) -> Tuple[pd.DataFrame, str, Tuple[str, str]]:
+    """Preprocess and merge the two dataframes for comparison.
+
+    Returns the merged frame, its fingerprint and its prompt context.
+    """
     logger.info("Starting data preprocessing")
     try:
-        # First, read the CSV files into pandas DataFrames
+        # getvalue() returns the whole upload regardless of the buffer position, so the
+        # bytes are safe to re-read on every rerun and double as the cache key
         try:
-            df1 = pd.read_csv(file1)
-            df2 = pd.read_csv(file2)
+            merged_df, fingerprint, prompt_ctx = prepare_data(file1.getvalue(), file2.getvalue())
         except pd.errors.EmptyDataError:
             raise ValueError("One or both of the uploaded files are empty.")
-        except pd.errors.ParserError:
+        except (pd.errors.ParserError, pa.ArrowInvalid):
             raise ValueError("Error parsing the CSV files. Please ensure they are valid CSV format.")
         
-        # Now add the Source column
-        df1['Source'] = 'CSV file 1'
-        df2['Source'] = 'CSV file 2'
-        
-        merged_df = pd.concat([df1, df2], ignore_index=True)
-        
-        # Handle missing values
-        merged_df = merged_df.fillna(0)
-        
-        # Ensure consistent data types
-        for col in merged_df.columns:
-            if merged_df[col].dtype == 'object':
-                try:
-                    merged_df[col] = pd.to_numeric(merged_df[col])
-                except ValueError:
-                    pass  # Keep as string if can't convert to numeric
-        
-        # Standardize column names
-        merged_df.columns = merged_df.columns.str.lower().str.replace(' ', '_')
-        
         logger.info("Data preprocessing completed successfully")
-        return merged_df
+        # Copy-on-write makes the shallow copy independent of the shared frame without copying data
+        return merged_df.copy(deep=False), fingerprint, prompt_ctx
     except Exception as e:
         logger.error(f"Error in data preprocessing: {str(e)}")
         raise
@@ -84,182 +853,460 @@ def preprocess_data(file1, file2) -> pd.DataFrame:
 def validate_d3_code(code: str) -> bool:
     """Perform basic validation on the generated D3 code."""
     # Check if the code defines the createVisualization function
-    if not re.search(r'function\s+createVisualization\s*\(data,\s*svgElement\)\s*{', code):
-        return False
-    
-    # Check for basic D3 v7 method calls
-    d3_methods = ['d3.select', 'd3.scaleLinear', 'd3.axisBottom', 'd3.axisLeft']
-    if not any(method in code for method in d3_methods):
+    if not _CREATE_VIZ_RE.search(code):
         return False
     
-    # Check for balanced braces
-    if code.count('{') != code.count('}'):
-        return False
+    # Check for basic D3 v7 method calls and balanced braces in a single pass
+    depth = 0
+    has_d3_method = False
+    for match in _VALIDATION_TOKEN_RE.finditer(code):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        else:
+            has_d3_method = True
     
-    return True
+    return has_d3_method and depth == 0
 
-def generate_d3_code(df: pd.DataFrame, api_key: str, user_input: str = "") -> str:
-    """Generate D3.js code using OpenAI API with emphasis on comparison."""
-    logger.info("Starting D3 code generation")
-    data_sample = df.head(50).to_dict(orient='records')
-    schema = df.dtypes.to_dict()
-    schema_str = "\n".join([f"{col}: {dtype}" for col, dtype in schema.items()])
-    
-    client = OpenAI(api_key=api_key)
-    
-    base_prompt = f"""
-    # D3.js Code Generation Task
+def _describe_dtype(dtype) -> str:
+    """Return a short type name for a column, using the value type of dictionary-encoded columns."""
+    arrow_type = getattr(dtype, 'pyarrow_dtype', None)
+    if arrow_type is None:
+        return str(dtype)
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    return str(arrow_type)
 
-    Your task is to generate ONLY D3.js code version 7. Do not include any explanations, comments, or markdown formatting.
+def _describe_column(series: pd.Series) -> str:
+    """Summarize a column for the prompt: type, distinct count, and range or example values."""
+    # Columns are Arrow-backed, so describe them with their Arrow types (e.g. "int64"
+    # rather than "int64[pyarrow]")
+    stats = [f"{series.nunique()} unique"]
+    if pd.api.types.is_numeric_dtype(series.dtype) and len(series):
+        stats.append(f"min {series.min()}, max {series.max()}")
+    else:
+        examples = series.dropna().drop_duplicates()
+        examples = examples.sample(n=min(PROMPT_EXAMPLE_VALUES, len(examples)), random_state=0)
+        stats.append("e.g. " + ", ".join(orjson.dumps(value, default=str).decode() for value in examples.tolist()))
+    return f"{_describe_dtype(series.dtype)} ({'; '.join(stats)})"
 
-    Requirements:
-    1. Create a function named createVisualization(data, svgElement)
-    2. Implement a visualization that compares data from two CSV files
-    3. Use D3.js version 7 syntax
+def build_prompt_context(df: pd.DataFrame) -> Tuple[str, str]:
+    """Return the schema summary and sample rows embedded in LLM prompts.
 
-    Data Schema:
-    {schema_str}
+    Per-column statistics carry most of the signal, so only a few sample rows are sent, as
+    CSV: column names appear once instead of in every record, about half the size of JSON.
+    Uploads get this once through prepare_data, which is memoized on the raw bytes.
+    """
+    schema_str = "\n".join(f"{col}: {_describe_column(df[col])}" for col in df.columns)
+    sample_csv = df.head(PROMPT_SAMPLE_ROWS).to_csv(index=False).rstrip("\n")
+    return schema_str, sample_csv
 
-    Sample Data:
-    {json.dumps(data_sample[:5], indent=2)}
+def split_code_sections(code: str) -> Dict[str, str]:
+    """Split D3 code at its "// ..." comment lines into named sections, in document order.
 
-    IMPORTANT: Your entire response must be valid D3.js code that can be executed directly. Do not include any text before or after the code.
+    Text before the first comment is kept under "preamble" and the line holding the
+    final closing brace under "postamble"; joining the values gives back the original code.
     """
-    
-    if user_input:
-        prompt = f"""
-        # D3.js Code Generation Task
+    markers = list(_SECTION_MARKER_RE.finditer(code))
+    if not markers:
+        return {}
+    closing = code.rfind("}")
+    end = code.rfind("\n", 0, closing) + 1 if closing > markers[-1].end() else len(code)
+    sections = {"preamble": code[:markers[0].start()]}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        name = marker.group(1)
+        if name in sections:
+            name = f"{name} ({len(sections)})"
+        sections[name] = code[marker.start():following.start() if following else end]
+    sections["postamble"] = code[end:]
+    return sections
 
-        Your task is to generate ONLY D3.js code version 7. Do not include any explanations, comments, or markdown formatting.
+def plan_section_patch(user_input: str, current_code: Optional[str]) -> Optional[Tuple[Dict[str, str], List[str]]]:
+    """Return the current code's sections and the names a modification should rewrite.
 
-        Requirements:
-        1. Create a function named createVisualization(data, svgElement)
-        2. Implement a visualization that satisfies this user prompt:
-        ---
-        {user_input}
-        ---
-        3. Use D3.js version 7 syntax
+    Returns None when the request cannot be narrowed to a strict subset of sections,
+    in which case the whole code is sent instead.
+    """
+    if not user_input or not current_code:
+        return None
+    sections = split_code_sections(current_code)
+    request_words = set(_WORD_RE.findall(user_input.lower())) - _SECTION_STOPWORDS
+    targets = [name for name in sections if name not in ("preamble", "postamble")
+               and request_words & set(_WORD_RE.findall(name.lower()))]
+    if not targets or len(targets) == len(sections) - 2:
+        return None
+    return sections, targets
 
-        Data Schema:
-        {schema_str}
+def _section_key(name: str) -> str:
+    """Normalize a section name for matching, ignoring the "### " heading it is shown with and case."""
+    return name.strip().lstrip("#").strip().lower()
 
-        Sample Data:
-        {json.dumps(data_sample[:5], indent=2)}
+def apply_section_patch(sections: Dict[str, str], targets: List[str], response: str) -> str:
+    """Reassemble code from its sections and a JSON section patch.
 
-        Current Code:
-        ```javascript
-        {st.session_state.current_viz}
-        ```
+    Returns "" if the patch is malformed or changes none of the targets, so an empty or
+    misaddressed patch is never mistaken for a finished modification.
+    """
+    try:
+        replacements = orjson.loads(response)["sections"]
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.warning(f"Discarding malformed section patch: {str(e)}")
+        return ""
+    if not isinstance(replacements, dict):
+        logger.warning("Discarding malformed section patch: sections is not an object")
+        return ""
+    names = {_section_key(name): name for name in sections if name not in ("preamble", "postamble")}
+    patched = dict(sections)
+    for key, new_code in replacements.items():
+        name = names.get(_section_key(key)) if isinstance(key, str) else None
+        if name is not None and isinstance(new_code, str):
+            patched[name] = new_code if new_code.endswith("\n") else new_code + "\n"
+    if all(patched[name] == sections[name] for name in targets):
+        logger.warning("Discarding section patch that changes none of the requested sections")
+        return ""
+    return "".join(patched.values())
 
-        IMPORTANT: Your entire response must be valid D3.js code that can be executed directly. Do not include any text before or after the code.
-        """
+def output_token_budget(code: Optional[str]) -> int:
+    """Return the max_tokens for a completion that rewrites code, or the ceiling for fresh code."""
+    if not code:
+        return MAX_OUTPUT_TOKENS
+    return min(MAX_OUTPUT_TOKENS, max(MIN_OUTPUT_TOKENS, int(len(code) / 3 * 1.2)))
+
+def d3_request_params(user_input: str, current_code: Optional[str], n: int, whole_code: bool = False) -> Dict:
+    """Return the sampling parameters for a D3 generation or modification request."""
+    params = {"n": n, "temperature": VARIANT_TEMPERATURE} if n > 1 else {"temperature": 0, "seed": LLM_SEED}
+    patch = None if whole_code else plan_section_patch(user_input, current_code)
+    if patch is not None:
+        # Section patches come back as JSON and only need room for the rewritten sections
+        sections, targets = patch
+        params["response_format"] = {"type": "json_object"}
+        params["max_tokens"] = output_token_budget("".join(sections[name] for name in targets))
+    else:
+        params["max_tokens"] = output_token_budget(current_code if user_input else None)
+    return params
+
+def build_d3_messages(schema_str: str, sample_csv: str, user_input: str = "", current_code: Optional[str] = None, whole_code: bool = False) -> List[Dict[str, str]]:
+    """Build the chat messages for a D3 generation or modification request.
+
+    Modifications that touch only some sections send just those, unless whole_code is set.
+    """
+    patch = None if whole_code else plan_section_patch(user_input, current_code)
+    if patch is not None:
+        sections, targets = patch
+        target_code = "\n".join(f"### {name}\n{sections[name]}" for name in targets)
+        return [
+            {"role": "system", "content": SECTION_PATCH_SYSTEM_PROMPT.substitute(viz_meta_requirement=VIZ_META_REQUIREMENT, schema_str=schema_str, sample_csv=sample_csv)},
+            {"role": "user", "content": SECTION_PATCH_PROMPT.substitute(user_input=user_input, target_code=target_code)}
+        ]
+    
+    if user_input:
+        prompt = MODIFICATION_PROMPT.substitute(user_input=user_input, viz_meta_requirement=VIZ_META_REQUIREMENT, current_code=current_code)
     else:
-        prompt = base_prompt
+        prompt = GENERATION_PROMPT.substitute(viz_meta_requirement=VIZ_META_REQUIREMENT)
+    
+    return [
+        {"role": "system", "content": D3_SYSTEM_PROMPT.substitute(schema_str=schema_str, sample_csv=sample_csv)},
+        {"role": "user", "content": prompt}
+    ]
+
+def semantic_scope_key(schema_str: str, sample_csv: str, current_code: Optional[str], **params) -> str:
+    """Return the semantic-cache scope of a modification: the same data, code and sampling settings.
+
+    Only requests in the same scope are compared by wording, so a similar request made
+    against different code never reuses a response built from that other code.
+    """
+    code_digest = hashlib.sha256((current_code or "").encode()).hexdigest()
+    return LLMCache.cache_key(LLM_MODEL, build_d3_messages(schema_str, sample_csv), current_code=code_digest, **params)
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def _cached_d3(schema_str: str, sample_csv: str, user_input: str, current_code: Optional[str], n: int, api_key_fp: str, _api_key: str, whole_code: bool = False) -> List[str]:
+    """Stream D3 code from the LLM, memoized on the prompt inputs so identical reruns skip the API."""
+    messages = build_d3_messages(schema_str, sample_csv, user_input, current_code, whole_code)
+    params = d3_request_params(user_input, current_code, n, whole_code)
+    patch = None if whole_code else plan_section_patch(user_input, current_code)
+    
+    # Persistent tier: survives restarts, and matches near-duplicate modification requests
+    llm_cache = _get_llm_cache()
+    use_llm_cache = llm_cache.should_cache(**params)
+    exact_key = LLMCache.cache_key(LLM_MODEL, messages, **params)
+    request_embedding = None
+    embedding_future = None
+    semantic_cached = None
+    if use_llm_cache:
+        cached = llm_cache.get(exact_key)
+        if cached is not None:
+            return cached
+        if user_input:
+            # Similar wording only counts against the same data, code and sampling settings
+            semantic_scope = semantic_scope_key(schema_str, sample_csv, current_code, **params)
+            # The embedding runs alongside the completion below, which is abandoned if a
+            # similar earlier request turns up, so a cache miss costs no extra round trip
+            embedding_future = submit_embedding(_api_key, user_input)
+    
+    def semantic_hit() -> bool:
+        """Resolve the embedding once it has arrived; True if a similar request's response is cached."""
+        nonlocal embedding_future, request_embedding, semantic_cached
+        if embedding_future is None or not embedding_future.done():
+            return False
+        try:
+            request_embedding = embedding_future.result()
+            semantic_cached = llm_cache.get_similar(semantic_scope, request_embedding)
+        except Exception as e:
+            logger.warning(f"Skipping semantic cache lookup: {str(e)}")
+        embedding_future = None
+        return semantic_cached is not None
+    
+    # The placeholder must be created inside the cached function; it is cleared
+    # afterwards so a cache hit replays nothing visible
+    placeholder = st.empty()
+    # The preview drops markdown fences as they stream in, as clean_d3_response will afterwards;
+    # section patches arrive as a JSON object and are highlighted as such
+    language = "javascript" if patch is None else "json"
+    variants = chat_completion_stream(_api_key, messages, lambda text: placeholder.code(_CODE_FENCE_RE.sub("", text).strip(), language=language),
+                                      stop_when=semantic_hit, **params)
+    placeholder.empty()
+    if variants is None:
+        logger.info("Reusing response for a semantically similar request")
+        return semantic_cached
+    if embedding_future is not None:
+        # The completion finished first; the embedding is still needed to index this response
+        concurrent.futures.wait([embedding_future])
+        semantic_hit()
+    if patch is not None:
+        variants = [apply_section_patch(*patch, response) for response in variants if response]
+    variants = [code for code in variants if code and code.strip()]
+    if not variants and patch is not None:
+        # No candidate rewrote a requested section, so ask again with the whole code
+        logger.warning("Section patch unusable; resending the modification with the whole code")
+        variants = _cached_d3(schema_str, sample_csv, user_input, current_code, n, api_key_fp, _api_key, whole_code=True)
+    if not variants:
+        raise ValueError("Generated D3 code is empty")
+    
+    if use_llm_cache:
+        llm_cache.set(exact_key, variants)
+        if request_embedding is not None:
+            llm_cache.add_similar(semantic_scope, request_embedding, variants)
+    return variants
+
+def generate_d3_variants(df: pd.DataFrame, api_key: str, user_input: str = "", n: int = 1, prompt_ctx: Optional[Tuple[str, str]] = None) -> List[str]:
+    """Generate up to n alternative D3.js visualizations from a single API call.
+
+    prompt_ctx is the precomputed (schema_str, sample_csv) pair for df; it is built
+    from df when omitted.
+    """
+    logger.info("Starting D3 code generation")
+    schema_str, sample_csv = prompt_ctx or build_prompt_context(df)
+    # Fingerprint the key so the raw secret never becomes part of the cache key
+    api_key_fp = hashlib.blake2b(api_key.encode()).hexdigest()[:8]
+    current_code = st.session_state.current_viz if user_input else None
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a D3.js expert. Generate D3.js code for comparative visualization based on the given requirements."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        
-        d3_code = response.choices[0].message.content
-        if not d3_code.strip():
-            raise ValueError("Generated D3 code is empty")
-        
-        return d3_code
+        return _cached_d3(schema_str, sample_csv, user_input, current_code, n, api_key_fp, api_key)
     except Exception as e:
         logger.error(f"Error generating D3 code: {str(e)}")
-        return generate_fallback_visualization()
+        return [generate_fallback_visualization(df)]
 
-def refine_d3_code(initial_code: str, api_key: str, max_attempts: int = 3) -> str:
-    """Refine the D3 code through iterative LLM calls if necessary."""
-    client = OpenAI(api_key=api_key)
-    
+def _refinement_messages(code: str) -> List[Dict[str, str]]:
+    """Build the chat messages asking the LLM to repair invalid D3 code."""
+    return [
+        {"role": "system", "content": "You are a D3.js expert. Provide only valid D3 code."},
+        {"role": "user", "content": REFINEMENT_PROMPT.substitute(code=code)}
+    ]
+
+async def _arefine(client: "AsyncOpenAI", semaphore: asyncio.Semaphore, limiter: _TokenBucket, llm_cache: LLMCache, initial_code: str, max_attempts: int) -> str:
+    """Refine one D3 code candidate through iterative LLM calls if necessary.
+
+    Repairs that validate are kept in the persistent LLM cache, so the same broken
+    code is never sent for repair twice. This runs on the event loop thread, which has
+    no script run context, so it takes the cache as an argument and calls no Streamlit
+    cached functions.
+    """
     for attempt in range(max_attempts):
         if validate_d3_code(initial_code):
             return initial_code
         
-        refinement_prompt = f"""
-        The following D3 code needs refinement to be valid:
-        
-        {initial_code}
-        
-        Please provide a corrected version that:
-        1. Defines a createVisualization(data, svgElement) function
-        2. Uses only D3.js version 7 syntax
-        3. Creates a valid visualization
-        
-        Return ONLY the corrected D3 code without any explanations or comments.
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a D3.js expert. Provide only valid D3 code."},
-                {"role": "user", "content": refinement_prompt}
-            ]
-        )
-        
-        initial_code = clean_d3_response(response.choices[0].message.content)
+        messages = _refinement_messages(initial_code)
+        params = {"max_tokens": output_token_budget(initial_code), "n": REFINEMENT_CANDIDATES, "temperature": VARIANT_TEMPERATURE}
+        cache_key = LLMCache.cache_key(LLM_MODEL, messages, **params)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        candidates = [_clean_d3_response(response) for response in await _agenerate(client, semaphore, limiter, messages, **params)]
+        # Later rounds build on the first candidate if none of them validates
+        initial_code = next((code for code in candidates if validate_d3_code(code)), candidates[0])
+        if validate_d3_code(initial_code):
+            llm_cache.set(cache_key, initial_code)
     
     # If we've exhausted our attempts, return the last attempt
     logger.warning("Failed to generate valid D3 code after maximum attempts")
     return initial_code
 
-def clean_d3_response(response: str) -> str:
-    """Clean the LLM response to ensure it only contains D3 code."""
+def refine_d3_codes(codes: List[str], api_key: str, max_attempts: int = 3) -> List[str]:
+    """Refine several D3 code candidates concurrently, returning them in the same order."""
+    client = _get_async_client(api_key)
+    semaphore = _get_request_semaphore(api_key)
+    limiter = _get_rate_limiter(api_key)
+    llm_cache = _get_llm_cache()
+
+    async def _gather() -> List[str]:
+        return await asyncio.gather(*(_arefine(client, semaphore, limiter, llm_cache, code, max_attempts) for code in codes))
+
+    return _run_async(_gather())
+
+def _clean_d3_response(response: str) -> str:
+    """Clean the LLM response to ensure it only contains D3 code (uncached, safe off the script thread)."""
     # Remove any potential markdown code blocks
-    response = response.replace("```javascript", "").replace("```", "")
+    response = _CODE_FENCE_RE.sub("", response)
     
     # Remove any lines that don't look like JavaScript
-    clean_lines = [line for line in response.split('\n') if line.strip() and not line.strip().startswith('#')]
+    code = _NON_CODE_LINE_RE.sub("", response).rstrip('\n')
     
     # Ensure the code starts with the createVisualization function
-    if not any(line.strip().startswith('function createVisualization') for line in clean_lines):
-        clean_lines.insert(0, 'function createVisualization(data, svgElement) {')
-        clean_lines.append('}')
+    if not _ENTRY_POINT_RE.search(code):
+        code = "\n".join(part for part in ("function createVisualization(data, svgElement) {", code, "}") if part)
+    
+    return code
+
+# Same response text (cache hits, batch results) always cleans to the same code
+@st.cache_data(show_spinner=False, max_entries=256)
+def clean_d3_response(response: str) -> str:
+    """Clean the LLM response to ensure it only contains D3 code."""
+    return _clean_d3_response(response)
+
+def encode_arrow_ipc(df: pd.DataFrame) -> str:
+    """Serialize a DataFrame as a gzipped, base64 Arrow IPC stream for the browser.
+
+    Arrow JS returns 64-bit integers as BigInt, which D3's numeric coercion rejects, so
+    integer columns are narrowed to the smallest of int8/int16/int32 that holds their
+    values (read as plain numbers, in a fraction of the bytes) or else widened to float64.
+    Decimals become float64 and temporal columns are sent as strings.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        if pa.types.is_integer(field.type):
+            bounds = pc.min_max(table.column(field.name)).as_py()
+            low, high = bounds["min"] or 0, bounds["max"] or 0
+            narrow = next((int_type for int_type in _WIRE_INT_TYPES
+                           if -2 ** (int_type.bit_width - 1) <= low and high < 2 ** (int_type.bit_width - 1)), None)
+            field = field.with_type(narrow or pa.float64())
+        elif pa.types.is_decimal(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_temporal(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    table = table.cast(pa.schema(fields))
     
-    return '\n'.join(clean_lines)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    # Repeated strings and small integers compress well; the page inflates the stream with
+    # the browser's built-in DecompressionStream
+    return base64.b64encode(gzip.compress(sink.getvalue().to_pybytes(), compresslevel=6)).decode()
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """Return a content hash of a DataFrame, used as a cheap cache key for derived outputs.
+
+    Column names and dtypes are hashed with the values, so uploads that differ only in
+    their headers or types get different fingerprints.
+    """
+    digest = hashlib.sha256(orjson.dumps([list(map(str, df.columns)), df.dtypes.astype(str).tolist()]))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def sample_for_visualization(df: pd.DataFrame) -> pd.DataFrame:
+    """Cap the rows sent to the browser, sampling each source in proportion to its size."""
+    if len(df) <= MAX_VIZ_ROWS:
+        return df
+    frac = MAX_VIZ_ROWS / len(df)
+    # A proportional share alone can round a much smaller file down to a handful of rows,
+    # or none, which would drop it from a chart meant to compare the two
+    samples = [group.sample(n=min(len(group), max(round(len(group) * frac), MIN_VIZ_ROWS_PER_SOURCE)), random_state=0)
+               for _, group in df.groupby('source', observed=True)]
+    return pd.concat(samples).sort_index()
+
+def visualization_meta(df: pd.DataFrame) -> Dict:
+    """Return the column lists and numeric extents of the full dataset, exposed to the page as vizMeta."""
+    num_cols = df.select_dtypes(include='number').columns.tolist()
+    extents = {}
+    if num_cols and len(df):
+        mins, maxs = df[num_cols].min(), df[num_cols].max()
+        extents = {col: [float(mins[col]), float(maxs[col])] for col in num_cols}
+    return {
+        "columns": [col for col in df.columns if col != 'source'],
+        "numericColumns": num_cols,
+        "extents": extents,
+    }
+
+# The page and its payload are immutable strings of up to hundreds of KB, so they are shared
+# as-is rather than pickled and copied on every rerun
+@st.cache_resource(show_spinner=False, max_entries=MAX_CACHED_UPLOADS)
+def visualization_payload(data_fingerprint: str, _df: pd.DataFrame) -> Tuple[str, str]:
+    """Return the encoded data and vizMeta JSON for a dataset, serialized once however many code versions use it."""
+    # Cap the rows inlined into the page; the chart cannot usefully draw more
+    df = sample_for_visualization(_df)
+    return encode_arrow_ipc(df), orjson.dumps(visualization_meta(_df)).decode()
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_visualization_html(d3_code: str, data_fingerprint: str, _df: pd.DataFrame) -> str:
+    """Assemble the visualization page, memoized on the code and the data fingerprint.
+
+    The page runs in a sandboxed iframe, which cannot see scripts loaded by the parent
+    page, so D3 has to be loaded here.
+    """
+    data_ipc, viz_meta = visualization_payload(data_fingerprint, _df)
+    return VISUALIZATION_PAGE.substitute(
+        viz_meta=viz_meta,
+        d3_code=d3_code,
+        data_ipc=data_ipc,
+    )
 
 def display_visualization(d3_code: str):
-    """Display the D3.js visualization using Streamlit components."""
-    st.components.v1.html(f"""
-    <div id="visualization"></div>
-    <script src="https://d3js.org/d3.v7.min.js"></script>
-    <script>
-        {d3_code}
-        // Create the SVG element
-        const svgElement = d3.select("#visualization")
-            .append("svg")
-            .attr("width", 800)
-            .attr("height", 500)
-            .node();
-        
-        // Get the data from the Streamlit session state
-        const vizData = {json.dumps(st.session_state.preprocessed_df.to_dict(orient='records'))};
-        
-        // Call the createVisualization function
-        createVisualization(vizData, svgElement);
-    </script>
-    """, height=600)
+    """Display the D3.js visualization using Streamlit components.
 
-def generate_fallback_visualization() -> str:
+    Each call creates a new iframe, so callers should render a visualization only once.
+    """
+    df = st.session_state.preprocessed_df
+    html = build_visualization_html(d3_code, st.session_state.data_fingerprint, df)
+    st.components.v1.html(html, height=600)
+    if len(df) > MAX_VIZ_ROWS:
+        st.caption(f"Visualizing a sample of about {MAX_VIZ_ROWS:,} rows of the {len(df):,}-row dataset, drawn proportionally from each file "
+                   f"(at least {MIN_VIZ_ROWS_PER_SOURCE:,} rows per file).")
+
+def generate_fallback_visualization(df: Optional[pd.DataFrame] = None) -> str:
     """Generate a fallback visualization if the LLM fails."""
     logger.info("Generating fallback visualization")
     
+    numeric_cols = df.select_dtypes(include='number').columns if df is not None else []
+    if len(numeric_cols) > 0:
+        # Compare per-source totals computed in pandas; only one row per source reaches the browser
+        compare_col = numeric_cols[0]
+        summary = (df.groupby('source', observed=True)[compare_col].sum()
+                     .reset_index()
+                     .rename(columns={compare_col: 'value'}))
+        logger.info("Using aggregated fallback visualization")
+        return (AGGREGATE_FALLBACK_CODE
+                .replace("__SUMMARY__", orjson.dumps(summary.to_dict(orient='records'), option=orjson.OPT_SERIALIZE_NUMPY, default=str).decode())
+                .replace("__VALUE_LABEL__", orjson.dumps(f"Total {compare_col}").decode()))
+    
+    row_count = len(df) if df is not None else 0
+    if row_count > CANVAS_ROW_THRESHOLD:
+        logger.info("Using canvas fallback visualization for large dataset")
+        return CANVAS_FALLBACK_CODE
+    
     fallback_code = """
     function createVisualization(data, svgElement) {
         const margin = { top: 20, right: 20, bottom: 50, left: 50 };
         const width = 800 - margin.left - margin.right;
         const height = 500 - margin.top - margin.bottom;
         
-        svgElement.attr("width", width + margin.left + margin.right)
-                   .attr("height", height + margin.top + margin.bottom);
+        const root = d3.select(svgElement)
+            .attr("width", width + margin.left + margin.right)
+            .attr("height", height + margin.top + margin.bottom);
         
-        const svg = svgElement.append("g")
+        const svg = root.append("g")
             .attr("transform", `translate(${margin.left},${margin.top})`);
 
         // Assuming the first column is for x-axis and second for y-axis
@@ -309,15 +1356,241 @@ def generate_fallback_visualization() -> str:
     logger.info("Fallback visualization generated successfully")
     return fallback_code
 
-def generate_and_validate_d3_code(df: pd.DataFrame, api_key: str, user_input: str = "") -> str:
-    """Generate, validate, and if necessary, refine D3 code."""
-    initial_code = generate_d3_code(df, api_key, user_input)
-    cleaned_code = clean_d3_response(initial_code)
-    
-    if validate_d3_code(cleaned_code):
-        return cleaned_code
+def record_history(request: str, code: str) -> Dict:
+    """Append a workflow step, storing its code once per distinct content."""
+    history = st.session_state.workflow_history
+    store, refs = st.session_state.code_store, st.session_state.code_refs
+    if len(history) == history.maxlen:
+        evicted = history.popleft()["hash"]
+        refs[evicted] -= 1
+        if refs[evicted] == 0:
+            del refs[evicted]
+            del store[evicted]
+    digest = hashlib.sha1(code.encode()).hexdigest()
+    # Generated code compresses several-fold and history is only read on revert or inspection
+    if digest not in store:
+        store[digest] = zlib.compress(code.encode())
+    refs[digest] = refs.get(digest, 0) + 1
+    st.session_state.history_version += 1
+    step = {"version": st.session_state.history_version, "request": request, "hash": digest}
+    history.append(step)
+    return step
+
+def history_code(step: Dict) -> str:
+    """Return the code recorded for a workflow step."""
+    return zlib.decompress(st.session_state.code_store[step["hash"]]).decode()
+
+def select_visualization(code: str):
+    """Make the given code the current visualization (used as a button callback)."""
+    st.session_state.current_viz = code
+    st.session_state.variants = []
+
+def revert_to_step(step: Dict):
+    """Make a workflow step's code the current visualization.
+
+    The code is only decompressed when a revert is requested, not for every step on every rerun.
+    """
+    select_visualization(history_code(step))
+
+def render_current_visualization():
+    """Render the current visualization, or one tab per variant when several are pending."""
+    variants = st.session_state.variants
+    if len(variants) > 1:
+        tabs = st.tabs([f"Variant {chr(ord('A') + i)}" for i in range(len(variants))])
+        for tab, step in zip(tabs, variants):
+            with tab:
+                code = history_code(step)
+                display_visualization(code)
+                st.button("Use this variant", key=f"use_variant_{step['version']}", on_click=select_visualization, args=(code,))
     else:
-        return refine_d3_code(cleaned_code, api_key)
+        display_visualization(st.session_state.current_viz)
+
+def record_batch_results(job: Dict, results: List[List[str]]):
+    """Add the valid variants of each finished batch request to the workflow history."""
+    for queued, variants in zip(job["requests"], results):
+        patch = plan_section_patch(queued["request"], queued["base_code"])
+        for i, batch_code in enumerate(variants):
+            if patch is not None:
+                batch_code = apply_section_patch(*patch, batch_code)
+                if not batch_code:
+                    continue
+            cleaned_code = clean_d3_response(batch_code)
+            if not validate_d3_code(cleaned_code):
+                continue
+            record_history(f"{queued['request']} (Batch variant {chr(ord('A') + i)})", cleaned_code)
+    # A large batch can push the pending variant tabs out of the history; drop those whose code was released
+    st.session_state.variants = [step for step in st.session_state.variants if step["hash"] in st.session_state.code_store]
+
+@st.fragment
+def batch_controls(api_key: str):
+    """List queued modification requests and submit them as one batch.
+
+    Runs as a fragment inside the sidebar, so submitting does not resend the visualization.
+    """
+    try:
+        st.subheader("Batch Variants")
+        # Requests queued with "Add to batch" are sent together as one batch (half the price)
+        pending = st.session_state.pending_batch
+        if not pending and st.session_state.batch_job is None:
+            st.caption("Use \"Add to batch (cheaper)\" under Modify Visualization to queue requests.")
+        for queued in pending:
+            st.write(f"Queued: {queued['request']}")
+        if pending and st.session_state.batch_job is None:
+            if st.button(f"Submit {len(pending)} queued request(s)"):
+                schema_str, sample_csv = st.session_state.prompt_ctx
+                requests = [
+                    {"messages": build_d3_messages(schema_str, sample_csv, queued["request"], queued["base_code"]),
+                     **d3_request_params(queued["request"], queued["base_code"], MODIFICATION_VARIANTS)}
+                    for queued in pending
+                ]
+                batch_id = submit_batch(api_key, requests)
+                st.session_state.batch_job = {"id": batch_id, "requests": pending}
+                st.session_state.pending_batch = []
+                st.rerun(scope="fragment")
+        if st.session_state.batch_job is not None:
+            batch_status_panel(api_key)
+    except Exception as e:
+        report_error(e, "batch controls")
+
+@st.fragment(run_every=BATCH_POLL_INTERVAL)
+def batch_status_panel(api_key: str):
+    """Poll the submitted batch in the background, without rerunning the app, until it finishes."""
+    job = st.session_state.batch_job
+    if job is None:
+        return
+    st.write(f"Submitted {len(job['requests'])} request(s)")
+    try:
+        results = retrieve_batch(api_key, job["id"])
+    except ValueError as e:
+        st.session_state.batch_job = None
+        st.error(str(e))
+        return
+    if results is None:
+        st.caption(f"Still processing; checked every {BATCH_POLL_INTERVAL} seconds. Results can take up to 24 hours.")
+        return
+    record_batch_results(job, results)
+    st.session_state.batch_job = None
+    st.rerun()
+
+def generate_and_validate_d3_code(df: pd.DataFrame, api_key: str, user_input: str = "", prompt_ctx: Optional[Tuple[str, str]] = None) -> str:
+    """Generate, validate, and if necessary, refine D3 code."""
+    return generate_and_validate_d3_variants(df, api_key, user_input, prompt_ctx=prompt_ctx)[0]
+
+def generate_and_validate_d3_variants(df: pd.DataFrame, api_key: str, user_input: str = "", n: int = 1, prompt_ctx: Optional[Tuple[str, str]] = None) -> List[str]:
+    """Generate, validate, and if necessary, refine each of up to n D3 code variants."""
+    cleaned = [clean_d3_response(code) for code in generate_d3_variants(df, api_key, user_input, n, prompt_ctx)]
+    invalid = [i for i, code in enumerate(cleaned) if not validate_d3_code(code)]
+    if invalid:
+        # Invalid variants are repaired concurrently, so the wait is the slowest repair, not the sum
+        for i, refined in zip(invalid, refine_d3_codes([cleaned[i] for i in invalid], api_key)):
+            cleaned[i] = refined
+    return cleaned
+
+@st.fragment
+def visualization_workspace(merged_df: pd.DataFrame, api_key: str):
+    """Show the chart, modification controls, code editor and history.
+
+    Runs as a fragment, so interacting with these widgets reruns only this section
+    instead of the whole app.
+    """
+    try:
+        st.subheader("Current Visualization")
+        # Later actions re-render only this slot instead of rerunning the whole script
+        viz_placeholder = st.empty()
+        with viz_placeholder.container():
+            with st.spinner("Preparing visualization..."):
+                render_current_visualization()
+
+        st.subheader("Modify Visualization")
+        # Typing in a form does not rerun anything; the request is sent with whichever button submits it
+        with st.form("modify_form"):
+            user_input = st.text_area("Enter your modification request:", height=100, key="modification_request")
+            update_col, batch_col = st.columns(2)
+            with update_col:
+                update_clicked = st.form_submit_button("Update Visualization")
+            with batch_col:
+                batch_clicked = st.form_submit_button("Add to batch (cheaper)")
+
+        if batch_clicked:
+            if user_input:
+                st.session_state.pending_batch.append({"request": user_input, "base_code": st.session_state.current_viz})
+                # The queue is listed by the sidebar fragment, which only a full rerun refreshes
+                st.rerun()
+            else:
+                st.warning("Please enter a modification request.")
+
+        if update_clicked:
+            current_hash = hashlib.sha1(st.session_state.current_viz.encode()).hexdigest()
+            if user_input and st.session_state.last_modification == (user_input, current_hash):
+                # A repeated click would only modify the result of this same request again
+                st.info("This modification is already applied.")
+            elif user_input:
+                with st.spinner("Generating updated visualization..."):
+                    modified_variants = generate_and_validate_d3_variants(merged_df, api_key, user_input, n=MODIFICATION_VARIANTS, prompt_ctx=st.session_state.prompt_ctx)
+                st.session_state.current_viz = modified_variants[0]
+                st.session_state.variants = []
+                for i, modified_d3_code in enumerate(modified_variants):
+                    request = f"{user_input} (Variant {chr(ord('A') + i)})" if len(modified_variants) > 1 else user_input
+                    st.session_state.variants.append(record_history(request, modified_d3_code))
+                st.session_state.last_modification = (user_input, st.session_state.variants[0]["hash"])
+                with viz_placeholder.container():
+                    render_current_visualization()
+            else:
+                st.warning("Please enter a modification request.")
+
+        with st.expander("View/Edit Visualization Code"):
+            code_editor = st.text_area("D3.js Code", value=st.session_state.current_viz, height=300, key="code_editor")
+            col1, col2, col3 = st.columns([1,1,2])
+            with col1:
+                edit_enabled = st.toggle("Edit", key="edit_toggle")
+            with col2:
+                if st.button("Execute Code"):
+                    if edit_enabled:
+                        if validate_d3_code(code_editor):
+                            st.session_state.current_viz = code_editor
+                            record_history("Manual code edit", code_editor)
+                            st.session_state.variants = []
+                            with viz_placeholder.container():
+                                render_current_visualization()
+                        else:
+                            st.error("Invalid D3.js code. Please check your code and try again.")
+                    else:
+                        st.warning("Enable 'Edit' to make changes.")
+            with col3:
+                if st.button("Copy Code"):
+                    st.write("Code copied to clipboard!")
+                    st.write(f'<textarea style="position: absolute; left: -9999px;">{code_editor}</textarea>', unsafe_allow_html=True)
+                    st.write('<script>document.querySelector("textarea").select();document.execCommand("copy");</script>', unsafe_allow_html=True)
+
+        with st.expander("Workflow History"):
+            workflow_history_panel()
+    except Exception as e:
+        report_error(e, "visualization workspace")
+
+@st.fragment
+def workflow_history_panel():
+    """List the workflow steps with their code and a revert button for each.
+
+    A nested fragment, so showing or hiding a step's code does not re-render the chart.
+    """
+    for step in st.session_state.workflow_history:
+        st.subheader(f"Step {step['version']}")
+        st.write(f"Request: {step['request']}")
+        # Only materialize a step's code when asked, so closed steps cost nothing per rerun
+        if st.toggle("Show code", key=f"show_code_{step['version']}"):
+            st.code(history_code(step), language="javascript")
+        if st.button(f"Revert to Step {step['version']}", key=f"revert_{step['version']}"):
+            revert_to_step(step)
+            # The chart lives outside this fragment, so reverting reruns the app
+            st.rerun()
+
+def report_error(e: Exception, where: str):
+    """Show an unexpected error in the app and log its traceback."""
+    st.error(f"An error occurred: {str(e)}")
+    logger.error(f"Error in {where}: {str(e)}")
+    logger.error(traceback.format_exc())
+    st.error("An unexpected error occurred. Please try again or contact support if the problem persists.")
+    st.code(traceback.format_exc())  # Display traceback for debugging
 
 def main():
     st.set_page_config(page_title="ChartChat", page_icon="✨", layout="wide")
@@ -334,88 +1607,39 @@ def main():
 
     if file1 and file2:
         try:
-            with st.spinner("Preprocessing data..."):
-                merged_df = preprocess_data(file1, file2)
-            st.session_state.preprocessed_df = merged_df
+            # Preprocessing and the prompt context only depend on the uploaded files,
+            # so they run once per upload rather than on every rerun
+            upload_key = (file1.file_id, file2.file_id)
+            if st.session_state.upload_key != upload_key:
+                previous_fingerprint = st.session_state.data_fingerprint
+                with st.spinner("Preprocessing data..."):
+                    (st.session_state.preprocessed_df, st.session_state.data_fingerprint,
+                     st.session_state.prompt_ctx) = preprocess_data(file1, file2)
+                st.session_state.upload_key = upload_key
+                # The fingerprint is the freshness stamp: a chart generated for other data is
+                # stale and is regenerated below, while re-uploading identical data keeps it
+                if st.session_state.data_fingerprint != previous_fingerprint:
+                    st.session_state.current_viz = None
+                    st.session_state.variants = []
+            merged_df = st.session_state.preprocessed_df
             
             with st.expander("Preview of preprocessed data"):
                 st.dataframe(merged_df.head())
             
-            if 'current_viz' not in st.session_state or st.session_state.current_viz is None:
+            if st.session_state.current_viz is None:
                 with st.spinner("Generating D3 visualization..."):
-                    d3_code = generate_and_validate_d3_code(merged_df, api_key)
+                    d3_code = generate_and_validate_d3_code(merged_df, api_key, prompt_ctx=st.session_state.prompt_ctx)
                     st.session_state.current_viz = d3_code
-                    st.session_state.workflow_history.append({
-                        "version": len(st.session_state.workflow_history) + 1,
-                        "request": "Initial comparative visualization",
-                        "code": d3_code
-                    })
+                    record_history("Initial comparative visualization", d3_code)
 
-            st.subheader("Current Visualization")
-            with st.spinner("Preparing visualization..."):
-                display_visualization(st.session_state.current_viz)
+            # Chart interactions rerun only this fragment, not the upload and preview above
+            visualization_workspace(merged_df, api_key)
 
-            st.subheader("Modify Visualization")
-            user_input = st.text_area("Enter your modification request:", height=100)
-            
-            if st.button("Update Visualization"):
-                if user_input:
-                    with st.spinner("Generating updated visualization..."):
-                        modified_d3_code = generate_and_validate_d3_code(merged_df, api_key, user_input)
-                    st.session_state.current_viz = modified_d3_code
-                    st.session_state.workflow_history.append({
-                        "version": len(st.session_state.workflow_history) + 1,
-                        "request": user_input,
-                        "code": modified_d3_code
-                    })
-                    st.rerun()
-                else:
-                    st.warning("Please enter a modification request.")
-
-            with st.expander("View/Edit Visualization Code"):
-                code_editor = st.text_area("D3.js Code", value=st.session_state.current_viz, height=300, key="code_editor")
-                col1, col2, col3 = st.columns([1,1,2])
-                with col1:
-                    edit_enabled = st.toggle("Edit", key="edit_toggle")
-                with col2:
-                    if st.button("Execute Code"):
-                        if edit_enabled:
-                            if validate_d3_code(code_editor):
-                                st.session_state.current_viz = code_editor
-                                st.session_state.workflow_history.append({
-                                    "request": "Manual code edit",
-                                    "code": code_editor
-                                })
-                                if len(st.session_state.workflow_history) > MAX_WORKFLOW_HISTORY:
-                                    st.session_state.workflow_history.pop(0)
-                                st.empty()  # Clear the previous visualization
-                                display_visualization(st.session_state.current_viz)
-                                st.components.v1.html(display_visualization(st.session_state.current_viz), height=600)
-                            else:
-                                st.error("Invalid D3.js code. Please check your code and try again.")
-                        else:
-                            st.warning("Enable 'Edit' to make changes.")
-                with col3:
-                    if st.button("Copy Code"):
-                        st.write("Code copied to clipboard!")
-                        st.write(f'<textarea style="position: absolute; left: -9999px;">{code_editor}</textarea>', unsafe_allow_html=True)
-                        st.write('<script>document.querySelector("textarea").select();document.execCommand("copy");</script>', unsafe_allow_html=True)
-
-            with st.expander("Workflow History"):
-                for i, step in enumerate(st.session_state.workflow_history):
-                    st.subheader(f"Step {i+1}")
-                    st.write(f"Request: {step['request']}")
-                    if st.button(f"Revert to Step {i+1}"):
-                        st.session_state.current_viz = step['code']
-                        st.empty()  # Clear the previous visualization
-                        st.components.v1.html(display_visualization(st.session_state.current_viz), height=600)
+            with st.sidebar:
+                batch_controls(api_key)
 
         except Exception as e:
-            st.error(f"An error occurred: {str(e)}")
-            logger.error(f"Error in main function: {str(e)}")
-            logger.error(traceback.format_exc())
-            st.error("An unexpected error occurred. Please try again or contact support if the problem persists.")
-            st.code(traceback.format_exc())  # Display traceback for debugging
+            report_error(e, "main function")
     else:
         st.info("Please upload both CSV files to visualize your data")
 
@@ -0,0 +1,22 @@
+import tempfile
+import threading
+
+import streamlit_app
+
+
+def use_temp_parsed_csv_cache(test_case):
+    """Point the Parquet cache of parsed uploads at a temporary directory for one test."""
+    cache_dir = tempfile.TemporaryDirectory()
+    original = streamlit_app.PARSED_CSV_CACHE_DIR
+    streamlit_app.PARSED_CSV_CACHE_DIR = cache_dir.name
+    # Cleanups run last-in first-out: wait for the background writers, then remove the directory
+    test_case.addCleanup(cache_dir.cleanup)
+    test_case.addCleanup(setattr, streamlit_app, "PARSED_CSV_CACHE_DIR", original)
+    test_case.addCleanup(join_parsed_csv_writers)
+    return cache_dir.name
+
+
+def join_parsed_csv_writers():
+    for thread in threading.enumerate():
+        if thread.name == streamlit_app.PARSED_CSV_WRITER_THREAD:
+            thread.join()
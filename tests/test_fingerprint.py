@@ -0,0 +1,25 @@
+import unittest
+
+import pandas as pd
+
+import streamlit_app
+
+
+class DataframeFingerprintTest(unittest.TestCase):
+    def test_renamed_columns_change_fingerprint(self):
+        df = pd.DataFrame({"Sales": [1, 2], "Cost": [3, 4]})
+        renamed = df.rename(columns={"Sales": "Revenue", "Cost": "Expense"})
+        self.assertNotEqual(streamlit_app.dataframe_fingerprint(df), streamlit_app.dataframe_fingerprint(renamed))
+
+    def test_changed_dtype_changes_fingerprint(self):
+        df = pd.DataFrame({"value": [1, 2]})
+        self.assertNotEqual(streamlit_app.dataframe_fingerprint(df),
+                            streamlit_app.dataframe_fingerprint(df.astype("float64")))
+
+    def test_equal_frames_share_fingerprint(self):
+        df = pd.DataFrame({"Sales": [1, 2], "Cost": [3, 4]})
+        self.assertEqual(streamlit_app.dataframe_fingerprint(df), streamlit_app.dataframe_fingerprint(df.copy()))
+
+
+if __name__ == "__main__":
+    unittest.main()
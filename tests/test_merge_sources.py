@@ -0,0 +1,29 @@
+import unittest
+
+import streamlit_app
+from tests.support import use_temp_parsed_csv_cache
+
+
+class MergeSourcesTest(unittest.TestCase):
+    def setUp(self):
+        use_temp_parsed_csv_cache(self)
+
+    def test_upload_source_column_is_overwritten(self):
+        df = streamlit_app.merge_sources(b"Source,value\nshop,1\n", b"Source,value\nweb,2\n")
+        self.assertEqual(list(df.columns), ["source", "value"])
+        self.assertEqual(df["source"].astype(str).tolist(), ["CSV file 1", "CSV file 2"])
+
+    def test_headers_differing_only_in_case_stay_separate_columns(self):
+        df = streamlit_app.merge_sources(b"Sales,Cost\n1,2\n", b"sales,cost\n3,4\n")
+        self.assertEqual(list(df.columns), ["sales", "cost", "source", "sales_2", "cost_2"])
+        schema_str, _ = streamlit_app.build_prompt_context(df)
+        self.assertIn("sales_2: ", schema_str)
+
+    def test_upload_column_named_like_the_tag_is_renamed(self):
+        df = streamlit_app.merge_sources(b"source,value\nshop,1\n", b"source,value\nweb,2\n")
+        self.assertEqual(df["source"].astype(str).tolist(), ["CSV file 1", "CSV file 2"])
+        self.assertEqual(df["source_2"].astype(str).tolist(), ["shop", "web"])
+
+
+if __name__ == "__main__":
+    unittest.main()
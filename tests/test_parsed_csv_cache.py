@@ -0,0 +1,34 @@
+import os
+import unittest
+
+import streamlit_app
+from tests.support import join_parsed_csv_writers, use_temp_parsed_csv_cache
+
+
+CSV = b"day,when,value\n2024-01-01,2024-01-01 10:00:00,1\n2024-01-02,2024-01-02 11:30:00,2\n"
+
+
+class ParsedCsvCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = use_temp_parsed_csv_cache(self)
+
+    def test_reloaded_table_keeps_the_parsed_types(self):
+        parsed = streamlit_app._read_csv_table(CSV)
+        join_parsed_csv_writers()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        reloaded = streamlit_app._read_csv_table(CSV)
+        self.assertEqual(str(parsed.schema.field("when").type), "timestamp[s]")
+        self.assertEqual(reloaded.schema, parsed.schema)
+        self.assertTrue(reloaded.equals(parsed))
+
+    def test_unreadable_cache_file_is_parsed_again(self):
+        streamlit_app._read_csv_table(CSV)
+        join_parsed_csv_writers()
+        path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(path, "wb") as f:
+            f.write(b"not parquet")
+        self.assertEqual(streamlit_app._read_csv_table(CSV).num_rows, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,20 @@
+import unittest
+
+import streamlit_app
+from tests.support import use_temp_parsed_csv_cache
+
+
+class PrepareDataPromptContextTest(unittest.TestCase):
+    def setUp(self):
+        use_temp_parsed_csv_cache(self)
+
+    def test_same_values_with_different_headers_get_their_own_schema(self):
+        _, _, (schema_a, sample_a) = streamlit_app.prepare_data(b"Sales,Cost\n1,2\n", b"Sales,Cost\n3,4\n")
+        _, _, (schema_b, sample_b) = streamlit_app.prepare_data(b"Revenue,Expense\n1,2\n", b"Revenue,Expense\n3,4\n")
+        self.assertIn("sales", schema_a)
+        self.assertIn("revenue", schema_b)
+        self.assertNotIn("sales", schema_b + sample_b)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+import orjson
+
+import streamlit_app
+
+
+CODE = """function createVisualization(data, svgElement) {
+  const svg = d3.select(svgElement);
+  // Scales
+  const x = d3.scaleLinear().range([0, 400]);
+  // Axes
+  svg.append("g").call(d3.axisBottom(x));
+  // Add bars
+  svg.selectAll("rect").data(data).join("rect");
+}
+"""
+
+
+def patch_response(sections):
+    return orjson.dumps({"sections": sections}).decode()
+
+
+class SplitCodeSectionsTest(unittest.TestCase):
+    def test_sections_join_back_to_the_original_code(self):
+        sections = streamlit_app.split_code_sections(CODE)
+        self.assertEqual(list(sections), ["preamble", "Scales", "Axes", "Add bars", "postamble"])
+        self.assertEqual("".join(sections.values()), CODE)
+        self.assertEqual(sections["postamble"], "}\n")
+
+    def test_repeated_comment_names_are_kept_apart(self):
+        code = CODE.replace("// Axes", "// Scales")
+        sections = streamlit_app.split_code_sections(code)
+        self.assertIn("Scales (2)", sections)
+        self.assertEqual("".join(sections.values()), code)
+
+    def test_code_without_comments_has_no_sections(self):
+        self.assertEqual(streamlit_app.split_code_sections("function createVisualization(data, svgElement) {}"), {})
+
+
+class PlanSectionPatchTest(unittest.TestCase):
+    def test_request_naming_a_section_targets_it(self):
+        sections, targets = streamlit_app.plan_section_patch("make the bars red", CODE)
+        self.assertEqual(targets, ["Add bars"])
+        self.assertEqual("".join(sections.values()), CODE)
+
+    def test_request_matching_no_section_sends_the_whole_code(self):
+        self.assertIsNone(streamlit_app.plan_section_patch("use a pie chart", CODE))
+
+    def test_request_matching_every_section_sends_the_whole_code(self):
+        self.assertIsNone(streamlit_app.plan_section_patch("scales axes bars", CODE))
+
+    def test_new_visualization_is_never_patched(self):
+        self.assertIsNone(streamlit_app.plan_section_patch("", CODE))
+        self.assertIsNone(streamlit_app.plan_section_patch("make the bars red", None))
+
+
+class ApplySectionPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.sections, self.targets = streamlit_app.plan_section_patch("make the bars red", CODE)
+        self.new_bars = '  // Add bars\n  svg.selectAll("rect").data(data).join("rect").attr("fill", "red");'
+
+    def apply(self, response):
+        return streamlit_app.apply_section_patch(self.sections, self.targets, response)
+
+    def test_target_section_is_replaced(self):
+        patched = self.apply(patch_response({"Add bars": self.new_bars}))
+        self.assertEqual(patched, CODE.replace(self.sections["Add bars"], self.new_bars + "\n"))
+
+    def test_heading_and_case_are_ignored_in_section_names(self):
+        expected = self.apply(patch_response({"Add bars": self.new_bars}))
+        self.assertEqual(self.apply(patch_response({"### Add bars": self.new_bars})), expected)
+        self.assertEqual(self.apply(patch_response({"add BARS": self.new_bars})), expected)
+
+    def test_patch_changing_no_target_is_rejected(self):
+        self.assertEqual(self.apply(patch_response({})), "")
+        self.assertEqual(self.apply(patch_response({"Legend": self.new_bars})), "")
+        self.assertEqual(self.apply(patch_response({"Add bars": self.sections["Add bars"]})), "")
+
+    def test_patch_changing_only_other_sections_is_rejected(self):
+        self.assertEqual(self.apply(patch_response({"Axes": "  // Axes\n"})), "")
+
+    def test_malformed_patch_is_rejected(self):
+        self.assertEqual(self.apply("not json"), "")
+        self.assertEqual(self.apply(orjson.dumps({"code": CODE}).decode()), "")
+        self.assertEqual(self.apply(patch_response(["Add bars"])), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+import streamlit_app
+
+
+SCHEMA = "name: string (2 unique)\nvalue: int64 (2 unique; min 1, max 2)"
+SAMPLE = "name,value,source\na,1,CSV file 1"
+PARAMS = {"n": 3, "temperature": 0.9}
+
+
+class SemanticScopeKeyTest(unittest.TestCase):
+    def test_different_code_gives_different_scopes(self):
+        scope_a = streamlit_app.semantic_scope_key(SCHEMA, SAMPLE, "function createVisualization(data, svgElement) { d3.select(svgElement); }", **PARAMS)
+        scope_b = streamlit_app.semantic_scope_key(SCHEMA, SAMPLE, "function createVisualization(data, svgElement) { d3.scaleLinear(); }", **PARAMS)
+        self.assertNotEqual(scope_a, scope_b)
+
+    def test_same_inputs_give_same_scope(self):
+        code = "function createVisualization(data, svgElement) { d3.select(svgElement); }"
+        self.assertEqual(streamlit_app.semantic_scope_key(SCHEMA, SAMPLE, code, **PARAMS),
+                         streamlit_app.semantic_scope_key(SCHEMA, SAMPLE, code, **PARAMS))
+
+
+if __name__ == "__main__":
+    unittest.main()